@@ -5,21 +5,28 @@ WireGuard configuration based on: https://popovy.ch/blog/wireguard-vpn-server-wi
 """
 
 import argparse
+import atexit
+import hashlib
 import json
 import logging
 import os
-import re
+import random
+import socket
+import string
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # External dependencies
 import httpx
-import paramiko
-from scp import SCPClient
 
 
 EXAMPLE = """Example usage:\n\n
 List the available regions:
 \tpython dropguard.py list --list-regions\n
+List the available regions and SSH keys:
+\tpython dropguard.py list --list-regions --list-keys\n
 Create a WireGuard VPN droplet with the name 'dropguard', adding SSH key with ID '12345678':
 \tpython dropguard.py create --name dropguard --ssh-keys 12345678 --private-key ~/.ssh/your_private_key\n
 Create a WireGuard VPN droplet with the name 'dropguard', adding SSH key with ID '12345678' in region Frankfurt:
@@ -37,7 +44,7 @@ except KeyError:
     exit(1)
 
 
-HEADERS = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+HEADERS = {"Authorization": f"Bearer {TOKEN}"}
 
 BASE_URL = "https://api.digitalocean.com"
 REGIONS_URL = "/v2/regions"
@@ -47,43 +54,174 @@ DROPLET_URL = "/v2/droplets"
 
 DROPLET_CONFIGS = ["s-1vcpu-512mb-10gb", "s-1vcpu-1gb"]
 
-FINISHED_PATTERN = re.compile("Cloud-init.+finished at")
+SSH_CONNECT_ATTEMPTS = 10
+CLOUD_INIT_TIMEOUT = 900
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "dropguard")
+
+# Shared client so that all API calls reuse the same connection
+_CLIENT = httpx.Client(headers=HEADERS, base_url=BASE_URL, timeout=httpx.Timeout(10.0, connect=5.0))
+atexit.register(_CLIENT.close)
 
 
 class DigitalOceanError(Exception):
     pass
 
 
-def request(url: str, data: dict = {}) -> dict:
+def _backoff(attempt: int, base: float = 2.0, cap: float = 30.0) -> float:
+    """Calculate an exponential backoff delay with jitter.
+
+    Args:
+        attempt: The number of attempts that have been made so far.
+        base: The delay to use for the first attempt in seconds.
+        cap: The maximum delay in seconds before jitter is applied.
+
+    Returns:
+        The number of seconds to sleep as a `float`.
+    """
+
+    return min(cap, base * 2**attempt) * random.uniform(0.75, 1.25)
+
+
+@lru_cache(maxsize=None)
+def user_data_template() -> string.Template:
+    """Load the cloud-init configuration once and prepare it for templating.
+
+    Returns:
+        The contents of `cloud_config.yml` as a `string.Template` with a `wg_port` placeholder.
+    """
+
+    with open("cloud_config.yml", "r") as config_fh:
+        # Escape the shell and nftables variables in the config before adding our own placeholder
+        return string.Template(config_fh.read().replace("$", "$$").replace("WG_PORT", "$wg_port"))
+
+
+def request(url: str, *, json_body: dict | None = None) -> dict:
     """Base function for performing requests.
 
     Args:
-        url: The URI of the API endpoint.
-        method: The HTTP method to use for the request.
-        data: The data to sent with a POST request.
+        url: The path of the API endpoint, relative to `BASE_URL`, or an absolute URL returned by the API.
+        json_body: The data to send as JSON with a POST request.
 
     Returns:
         The HTTP response as a `dict`.
     """
 
-    with httpx.Client(headers=HEADERS) as client:
-        if data:
-            r = client.post(url, data=data)
-        else:
-            r = client.get(url)
+    r = _CLIENT.post(url, json=json_body) if json_body is not None else _CLIENT.get(url)
+
+    return _parse_response(r)
 
-        res = json.loads(r.text)
 
-        if r.status_code != 200 and r.status_code != 202:
-            raise DigitalOceanError(f"{res['id']} - {res['message']}")
+def _parse_response(r: httpx.Response) -> dict:
+    """Check the status of an API response and parse its body.
+
+    Args:
+        r: The HTTP response returned by the API.
+
+    Returns:
+        The HTTP response as a `dict`.
+    """
+
+    if r.is_error:
+        try:
+            err = r.json()
+        except ValueError:
+            # Not a JSON error response (e.g. an HTML page for server errors)
+            raise DigitalOceanError(f"http_error - {r.status_code} {r.reason_phrase}")
+
+        raise DigitalOceanError(f"{err.get('id', 'http_error')} - {err.get('message', r.text[:200])}")
+
+    if r.status_code == 204:
+        return {}
+
+    return r.json()
+
+
+def cached_get(url: str, ttl: int = 3600) -> dict:
+    """Perform a GET request, caching the response on disk.
+
+    A cached response younger than `ttl` is returned as is, an older one is revalidated with its `ETag`.
+
+    Args:
+        url: The path of the API endpoint, relative to `BASE_URL`.
+        ttl: The number of seconds a cached response is used without revalidating it.
+
+    Returns:
+        The HTTP response as a `dict`.
+    """
+
+    # Keep the responses of different accounts apart
+    account_dir = os.path.join(CACHE_DIR, hashlib.sha256(TOKEN.encode()).hexdigest()[:12])
+    cache_file = os.path.join(account_dir, f"{url.rstrip('/').rsplit('/', 1)[-1]}.json")
+
+    try:
+        with open(cache_file, "r") as cache_fh:
+            cached = json.load(cache_fh)
+        cached_etag, cached_body = cached["etag"], cached["body"]
+        if not isinstance(cached_body, dict) or not isinstance(cached_etag, (str, type(None))):
+            raise TypeError("malformed cache file")
+        age = time.time() - os.path.getmtime(cache_file)
+    except (OSError, ValueError, KeyError, TypeError):
+        # Treat a missing or malformed cache file as a cache miss
+        cached_etag = cached_body = None
+
+    if cached_body is not None and age < ttl:
+        return cached_body
+
+    headers = {"If-None-Match": cached_etag} if cached_body is not None and cached_etag else {}
+    r = _CLIENT.get(url, headers=headers)
+
+    if r.status_code == 304:
+        # Unchanged since it was cached, only refresh the age of the cache file
+        try:
+            os.utime(cache_file)
+        except OSError as e:
+            logging.debug(f"failed to refresh cache file {cache_file}: {e}")
+        return cached_body
+
+    res = _parse_response(r)
+
+    # Write to a temporary file first so concurrent readers never see a partial cache file
+    tmp_name = None
+    try:
+        os.makedirs(account_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=account_dir, suffix=".tmp", delete=False) as cache_fh:
+            tmp_name = cache_fh.name
+            json.dump({"etag": r.headers.get("ETag"), "body": res}, cache_fh)
+        os.replace(tmp_name, cache_file)
+    except OSError as e:
+        # Caching is best effort, the response itself is still usable
+        logging.debug(f"failed to write cache file {cache_file}: {e}")
+        if tmp_name is not None:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
 
     return res
 
 
-def list_keys() -> None:
-    """Basic function for listing the available SSH keys."""
+def request_all(urls: list, use_cache: bool = True) -> list:
+    """Perform multiple GET requests concurrently over the shared client.
+
+    Args:
+        urls: The paths of the API endpoints, relative to `BASE_URL`.
+        use_cache: Whether to use the on-disk cache for the responses.
+
+    Returns:
+        The HTTP responses as a `list` of `dict`, in the same order as `urls`.
+    """
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return list(executor.map(cached_get if use_cache else request, urls))
+
 
-    res = request(url=f"{BASE_URL}{SSHKEYS_URL}")
+def list_keys(res: dict) -> None:
+    """Basic function for listing the available SSH keys.
+
+    Args:
+        res: The response of the SSH keys endpoint.
+    """
 
     for key in res["ssh_keys"]:
         logging.info(f"> {key['name']}")
@@ -92,10 +230,12 @@ def list_keys() -> None:
                 print(f"\t{field}: {info}")
 
 
-def list_images() -> None:
-    """Basic function for listing the images that are available."""
+def list_images(res: dict) -> None:
+    """Basic function for listing the images that are available.
 
-    res = request(url=f"{BASE_URL}{IMAGES_URL}")
+    Args:
+        res: The response of the images endpoint.
+    """
 
     logging.info(f"{res['meta']['total']} images available")
     for image in res["images"]:
@@ -105,10 +245,12 @@ def list_images() -> None:
                 print(f"\t{field}: {info}")
 
 
-def list_regions() -> None:
-    """Basic function for listing the regions and their information."""
+def list_regions(res: dict) -> None:
+    """Basic function for listing the regions and their information.
 
-    res = request(url=f"{BASE_URL}{REGIONS_URL}")
+    Args:
+        res: The response of the regions endpoint.
+    """
 
     for region in res["regions"]:
         if not region["available"]:
@@ -128,46 +270,93 @@ def config_status(ip: str, private_key: str, outfile: str) -> None:
         outfile: The output filename to use for the WireGuard configuration.
     """
 
+    # Imported here as it is slow to load and only needed when creating a droplet
+    import paramiko
+
     ssh_client = paramiko.SSHClient()
     ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-    while True:
-        # Monitor the cloud-init script status
+    try:
+        # Wait for the SSH server to come up on the Droplet, connecting only once
+        attempt = 0
+        while True:
+            try:
+                ssh_client.connect(hostname=ip, username="root", key_filename=private_key)
+                break
+            except paramiko.AuthenticationException as e:
+                # Retrying will not help with a wrong or passphrase-protected private key
+                raise DigitalOceanError(f"SSH authentication to {ip} failed: {e}")
+            except (paramiko.ssh_exception.NoValidConnectionsError, paramiko.SSHException, socket.timeout) as e:
+                # The SSH server takes a little while to start on the Droplet
+                attempt += 1
+                if attempt >= SSH_CONNECT_ATTEMPTS:
+                    raise DigitalOceanError(f"failed to connect to {ip} over SSH after {attempt} attempts: {e}")
+
+                delay = _backoff(attempt - 1)
+                logging.info(f"SSH connection attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+        # Keep the session alive in case cloud-init restarts the SSH server
+        ssh_client.get_transport().set_keepalive(15)
+
+        # Block on the Droplet until cloud-init reaches a final state
         logging.info("waiting for cloud-init to finish")
-        time.sleep(10)
+        _, stdout, _ = ssh_client.exec_command("cloud-init status --wait")
+        if not stdout.channel.status_event.wait(CLOUD_INIT_TIMEOUT):
+            raise DigitalOceanError("timed out waiting for cloud-init")
+        rc = stdout.channel.exit_status
 
-        try:
-            ssh_client.connect(hostname=ip, username="root", key_filename=private_key)
-        except paramiko.ssh_exception.NoValidConnectionsError:
-            # The SSH server takes a little while to start on the Droplet
-            continue
+        if rc == -1:
+            # No exit status was sent by the server before the channel closed
+            raise DigitalOceanError("connection lost while waiting for cloud-init")
 
-        _, stdout, _ = ssh_client.exec_command("cat /var/log/cloud-init-output.log")
+        if rc != 0:
+            raise DigitalOceanError(f"cloud-init reported degraded/error (exit status {rc})")
 
-        if re.search(FINISHED_PATTERN, stdout.readlines()[-1]):
-            # Check if the output indicates that the cloud-init script is finished (last line)
-            # Save the WireGuard configuration file that was created by the cloud-init script
-            logging.info("cloud-init finished, downloading WireGuard config")
-            scp_client = SCPClient(ssh_client.get_transport())
-            scp_client.get("/etc/wireguard/wg0-client.conf", outfile)
-            logging.info(f"configuration saved at {outfile}")
-            break
+        # Save the WireGuard configuration file that was created by the cloud-init script
+        logging.info("cloud-init finished, downloading WireGuard config")
+        with ssh_client.open_sftp() as sftp:
+            sftp.get("/etc/wireguard/wg0-client.conf", outfile)
+        logging.info(f"configuration saved at {outfile}")
+    finally:
+        ssh_client.close()
+
+
+def action_wait(action_href: str) -> None:
+    """Function to wait for an action to complete.
+
+    Args:
+        action_href: The URL of the action to wait for.
+    """
+
+    attempt = 0
+    while True:
+        time.sleep(_backoff(attempt, base=1.0, cap=10.0))
+        res = request(url=action_href)
+
+        if res["action"]["status"] == "completed":
+            return
+        if res["action"]["status"] == "errored":
+            raise DigitalOceanError(f"action {res['action']['id']} ({res['action']['type']}) errored")
 
-    ssh_client.close()
+        attempt += 1
 
 
-def droplet_status(droplet_id: str) -> dict:
+def droplet_status(droplet_id: str, action_href: str) -> dict:
     """Function to check droplet status after creation.
 
     Args:
         droplet_id: The ID that was given to the droplet upon creation.
+        action_href: The URL of the create action that was returned upon creation.
+
+    Returns:
+        The droplet information once it is active as a `dict`.
     """
 
-    while True:
-        time.sleep(5)
-        res = request(url=f"{BASE_URL}{DROPLET_URL}/{droplet_id}")
-        if res["droplet"]["status"] == "active":
-            return res["droplet"]
+    action_wait(action_href=action_href)
+
+    res = request(url=f"{DROPLET_URL}/{droplet_id}")
+    return res["droplet"]
 
 
 def create_droplet(port: str, name: str, region: str, size: str, ssh_keys: list, private_key: str, output: str) -> None:
@@ -187,10 +376,7 @@ def create_droplet(port: str, name: str, region: str, size: str, ssh_keys: list,
 
     logging.info(f"setting cloud_config.yml")
 
-    with open("cloud_config.yml", "r") as config_fh:
-        user_data = config_fh.read()
-
-    user_data = user_data.replace("WG_PORT", port)
+    user_data = user_data_template().substitute(wg_port=port)
 
     request_data = {
         "name": name,
@@ -204,12 +390,12 @@ def create_droplet(port: str, name: str, region: str, size: str, ssh_keys: list,
         "user_data": user_data,
     }
 
-    res = request(url=f"{BASE_URL}{DROPLET_URL}", data=json.dumps(request_data))
+    res = request(url=DROPLET_URL, json_body=request_data)
 
     logging.info("waiting for droplet to become active")
     try:
-        droplet_data = droplet_status(droplet_id=res["droplet"]["id"])
-    except KeyError:
+        droplet_data = droplet_status(droplet_id=res["droplet"]["id"], action_href=res["links"]["actions"][0]["href"])
+    except (KeyError, IndexError):
         logging.error(f"failed to check droplet status")
         return
 
@@ -225,16 +411,23 @@ def create_droplet(port: str, name: str, region: str, size: str, ssh_keys: list,
 
 def main(args):
     if args.action == "list":
+        listings = []
+        if args.list_regions:
+            listings.append((REGIONS_URL, list_regions))
+        if args.list_images:
+            listings.append((IMAGES_URL, list_images))
+        if args.list_keys:
+            listings.append((SSHKEYS_URL, list_keys))
+
+        if not listings:
+            logging.error("please pick a valid --list command or use 'list --help'")
+            exit(1)
+
         try:
-            if args.list_regions:
-                list_regions()
-            elif args.list_images:
-                list_images()
-            elif args.list_keys:
-                list_keys()
-            else:
-                logging.error("please pick a valid --list command or use 'list --help'")
-                exit(1)
+            # Fetch all requested listings at once, then print them in order
+            responses = request_all([url for url, _ in listings], use_cache=not args.no_cache)
+            for (_, list_func), res in zip(listings, responses):
+                list_func(res)
         except DigitalOceanError as e:
             logging.error(e)
             exit(1)
@@ -273,6 +466,7 @@ if __name__ == "__main__":
     listparser.add_argument("-lr", "--list-regions", action="store_true", required=False, help="List available regions")
     listparser.add_argument("-li", "--list-images", action="store_true", required=False, help="List available images")
     listparser.add_argument("-lk", "--list-keys", action="store_true", required=False, help="List available SSH keys")
+    listparser.add_argument("--no-cache", action="store_true", required=False, help="Do not use cached API responses")
 
     createparser = subparsers.add_parser("create")
     createparser.add_argument(